@@ -0,0 +1,217 @@
+"""リクエスト1件あたりのロギングのオーバーヘッドを計測するベンチマーク
+
+1. before/after: 変更前のリクエスト処理のログ呼び出し（legacy）を変更前の設定
+   （sync-text）で、変更後のログ呼び出し（request）を変更後の既定の設定
+   （queued-json、サンプリング率1.0）で実行し、1リクエストあたりの時間と
+   出力量を比較する。レート制限は通常の負荷では上限に達しないため外している。
+2. 同じログ呼び出しを以下のハンドラ構成で実行し、ハンドラごとの差を比較する。
+
+いずれも呼び出し元のスレッドでかかる時間（caller）と、キューに残ったログを
+書き出し終えるまでを含めた時間（total）を計測する。
+
+- sync-text:   変更前の設定（basicConfigによる同期出力）
+- sync-json:   同じJSON形式で同期出力
+- queued-json: setup_loggingによるキュー経由の非同期出力
+- queued-json(sample=0.1): 上記に加えてリクエストログを10%にサンプリング
+
+出力先はファイル、標準出力、書き込みが遅い出力先（1回の書き込みで0.1ms以上ブロックする。
+負荷の高い環境で標準出力のパイプが詰まった状態を模したもの）の3種類。
+結果は標準エラー出力に表示する。
+コンテナと同じくパイプに出力する場合の実行例:
+    python backend/benchmarks/logging_overhead.py --requests 5000 | cat > /dev/null
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from log_pipeline import JsonFormatter, setup_logging  # noqa: E402
+
+# 大きなユーザーメッセージ（要件定義の依頼文を想定）
+MESSAGE = "スマートフォン向けの健康管理アプリを開発したい。" * 200
+
+
+def legacy_workload(logger: logging.Logger) -> None:
+    # 変更前のミドルウェアとchat_endpointのログ呼び出し（ローカル環境）
+    request_id = str(uuid.uuid4())
+    logger.warning("Running in local environment - skipping token verification")
+    logger.info(f"Request ID: {request_id} - Starting request processing")
+    logger.info(f"Processing message: {MESSAGE}")
+    logger.info("Agent state before processing:")
+    logger.info("LLM model: gpt-4o")
+
+
+def request_workload(logger: logging.Logger) -> None:
+    # chat_endpointのログ呼び出し（DEBUGはINFOレベルでは出力されない）
+    request_id = str(uuid.uuid4())
+    logger.info(
+        "Starting request processing",
+        extra={"request_id": request_id, "message_length": len(MESSAGE)},
+    )
+    logger.debug(
+        "Processing message",
+        extra={"request_id": request_id, "user_message": MESSAGE},
+    )
+    logger.info(
+        "Request completed",
+        extra={"request_id": request_id, "iterations": 2, "stop_reason": "sufficient"},
+    )
+
+
+def large_payload_workload(logger: logging.Logger) -> None:
+    # 大きなペイロードをINFOで出力する場合（切り詰めの効果を見る）
+    logger.info(f"Processing message: {MESSAGE}", extra={"request_id": str(uuid.uuid4())})
+
+
+class SlowStream:
+    """書き込みのたびにブロックする出力先"""
+
+    def __init__(self, stream, delay: float = 0.0001):
+        self.stream = stream
+        self.delay = delay
+
+    def write(self, text: str) -> int:
+        time.sleep(self.delay)
+        return self.stream.write(text)
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+
+def reset_root() -> None:
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+
+
+def sync_text(stream):
+    reset_root()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        stream=stream,
+    )
+    return lambda: None
+
+
+def sync_json(stream):
+    reset_root()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter(max_field_length=2000))
+    logging.getLogger().addHandler(handler)
+    logging.getLogger().setLevel(logging.INFO)
+    return lambda: None
+
+
+def queued_json(sample_rate: float, requests: int):
+    def setup(stream):
+        reset_root()
+        listener = setup_logging(
+            sample_rates={"main.request": sample_rate},
+            queue_size=requests * 4,
+            stream=stream,
+        )
+        return listener.stop
+
+    return setup
+
+
+def measure(
+    setup, workload, stream, requests: int, logger_name: str = "main.request"
+) -> tuple[float, float]:
+    finish = setup(stream)
+    logger = logging.getLogger(logger_name)
+    start = time.perf_counter()
+    for _ in range(requests):
+        workload(logger)
+    caller = time.perf_counter() - start
+    # キューに残ったログを書き出し終えるまで待つ
+    finish()
+    stream.flush()
+    total = time.perf_counter() - start
+    return caller / requests * 1e6, total / requests * 1e6
+
+
+def open_sink(sink: str, path: str):
+    if sink == "file":
+        return open(path, "w")
+    if sink == "stdout":
+        return sys.stdout
+    return SlowStream(sys.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ロギングのオーバーヘッドを計測します")
+    parser.add_argument("--requests", type=int, default=5000, help="リクエスト数")
+    args = parser.parse_args()
+    sinks = ("file", "stdout", "slow")
+
+    print(f"requests: {args.requests}", file=sys.stderr)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # 1. 変更前と変更後のリクエスト処理の比較
+        before_after = [
+            ("before", legacy_workload, "main", sync_text),
+            ("after", request_workload, "main.request", queued_json(1.0, args.requests)),
+        ]
+        print("\n[before/after]", file=sys.stderr)
+        print(
+            f"{'sink':<7} {'':<7} {'caller us/req':>14} {'total us/req':>13} "
+            f"{'bytes/req':>10}",
+            file=sys.stderr,
+        )
+        for sink in sinks:
+            for label, workload, logger_name, setup in before_after:
+                path = os.path.join(tmpdir, f"{label}.log")
+                stream = open_sink(sink, path)
+                caller, total = measure(
+                    setup, workload, stream, args.requests, logger_name
+                )
+                size = "-"
+                if sink == "file":
+                    stream.close()
+                    size = f"{os.path.getsize(path) / args.requests:.0f}"
+                print(
+                    f"{sink:<7} {label:<7} {caller:14.2f} {total:13.2f} {size:>10}",
+                    file=sys.stderr,
+                )
+
+        # 2. 同じログ呼び出しでのハンドラ構成ごとの比較
+        configs = [
+            ("sync-text", sync_text),
+            ("sync-json", sync_json),
+            ("queued-json", queued_json(1.0, args.requests)),
+            ("queued-json(sample=0.1)", queued_json(0.1, args.requests)),
+        ]
+        workloads = [
+            ("request", request_workload),
+            ("large-payload", large_payload_workload),
+        ]
+        print("\n[same log calls]", file=sys.stderr)
+        print(
+            f"{'workload':<14} {'sink':<7} {'config':<24} "
+            f"{'caller us/req':>14} {'total us/req':>13}",
+            file=sys.stderr,
+        )
+        for workload_name, workload in workloads:
+            for sink in sinks:
+                for config_name, setup in configs:
+                    stream = open_sink(sink, os.path.join(tmpdir, f"{config_name}.log"))
+                    caller, total = measure(setup, workload, stream, args.requests)
+                    if sink == "file":
+                        stream.close()
+                    print(
+                        f"{workload_name:<14} {sink:<7} {config_name:<24} "
+                        f"{caller:14.2f} {total:13.2f}",
+                        file=sys.stderr,
+                    )
+    reset_root()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,14 @@
 import operator
+import threading
 from typing import Annotated, Any, Optional
 import os
 from dotenv import load_dotenv
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.outputs import LLMResult
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
+from langchain_core.runnables import RunnableConfig
 from langgraph.graph import END, StateGraph
 from pydantic import BaseModel, Field
 
@@ -39,10 +43,74 @@ class InterviewResult(BaseModel):
     )
 
 
+# 不足している情報のカテゴリを表すデータモデル
+class InformationGap(BaseModel):
+    category: str = Field(
+        ..., description="不足している情報のカテゴリ（例: 非機能要件、ターゲットユーザー）"
+    )
+    description: str = Field(..., description="不足している情報の具体的な内容")
+
+
 # 評価の結果を表すデータモデル
 class EvaluationResult(BaseModel):
     reason: str = Field(..., description="判断の理由")
     is_sufficient: bool = Field(..., description="情報が十分かどうか")
+    gaps: list[InformationGap] = Field(
+        ...,
+        description="不足している情報のカテゴリのリスト（情報が十分な場合は空のリスト）",
+    )
+
+
+# 1リクエストあたりのインタビュー数とトークン数の上限
+class InterviewBudget(BaseModel):
+    max_interviews: int = Field(
+        default=15, ge=1, description="1リクエストで実施するインタビューの最大数"
+    )
+    max_tokens: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description=(
+            "インタビューの反復で消費するトークンの最大数（Noneで無制限）。"
+            "直前の反復の実績（ペルソナ生成と評価の固定分、インタビュー1件あたりの分）から"
+            "次の反復の消費量を見積もり、上限に収まる人数に絞り込む。"
+            "初回の反復は実績がないため絞り込まず、最後の要件定義書の生成分は含まない"
+        ),
+    )
+
+
+# 1回の反復の各段階で消費したトークン数
+class RoundTokenUsage(BaseModel):
+    persona_generation: int = Field(default=0, description="ペルソナ生成で消費したトークン数")
+    interviews: int = Field(default=0, description="インタビューで消費したトークン数")
+    evaluation: int = Field(default=0, description="情報の評価で消費したトークン数")
+
+
+# 1回の反復の統計を表すデータモデル
+class IterationStats(BaseModel):
+    iteration: int = Field(..., description="反復回数")
+    personas_generated: int = Field(..., description="生成されたペルソナの数")
+    gap_count: int = Field(default=0, description="評価で検出された情報不足カテゴリの数")
+    is_sufficient: bool = Field(default=False, description="情報が十分と判断されたかどうか")
+    tokens_used: int = Field(default=0, description="この反復終了時点の累計トークン数")
+    round_tokens: RoundTokenUsage = Field(
+        default_factory=RoundTokenUsage, description="この反復の段階ごとのトークン数"
+    )
+
+
+# 反復全体の収束統計を表すデータモデル
+class ConvergenceStats(BaseModel):
+    iterations: list[IterationStats] = Field(
+        default_factory=list, description="反復ごとの統計"
+    )
+    total_interviews: int = Field(default=0, description="実施したインタビューの総数")
+    total_tokens: int = Field(default=0, description="消費したトークンの総数")
+    stop_reason: str = Field(default="", description="反復を終了した理由")
+
+
+# 要件定義書と収束統計をまとめた実行結果
+class DocumentationResult(BaseModel):
+    requirements_doc: str = Field(..., description="生成された要件定義")
+    stats: ConvergenceStats = Field(..., description="収束統計")
 
 
 # 要件定義生成AIエージェントのステート
@@ -61,6 +129,34 @@ class InterviewState(BaseModel):
     is_information_sufficient: bool = Field(
         default=False, description="情報が十分かどうか"
     )
+    current_personas: list[Persona] = Field(
+        default_factory=list, description="現在の反復で生成されたペルソナのリスト"
+    )
+    evaluation_reason: str = Field(default="", description="直近の評価の理由")
+    information_gaps: list[InformationGap] = Field(
+        default_factory=list, description="直近の評価で検出された情報不足カテゴリ"
+    )
+    iteration_stats: Annotated[list[IterationStats], operator.add] = Field(
+        default_factory=list, description="反復ごとの統計"
+    )
+    round_tokens: RoundTokenUsage = Field(
+        default_factory=RoundTokenUsage,
+        description="現在（評価後は直前）の反復の段階ごとのトークン数",
+    )
+    stop_reason: str = Field(default="", description="反復を終了した理由")
+
+
+# 1リクエスト内のLLM呼び出しで消費したトークン数を集計するコールバック
+class TokenUsageCallbackHandler(BaseCallbackHandler):
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.total_tokens = 0
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        # バッチ処理では複数スレッドから呼ばれるためロックで保護する
+        with self._lock:
+            self.total_tokens += token_usage.get("total_tokens", 0)
 
 
 # ペルソナを生成するクラス
@@ -69,7 +165,16 @@ class PersonaGenerator:
         self.llm = llm.with_structured_output(Personas)
         self.k = k
 
-    def run(self, user_request: str) -> Personas:
+    def run(
+        self,
+        user_request: str,
+        k: Optional[int] = None,
+        gaps: Optional[list[InformationGap]] = None,
+    ) -> Personas:
+        # 不足情報が指定されている場合はそれを補うペルソナに絞って生成
+        if gaps:
+            return self._generate_targeted(user_request, k or len(gaps), gaps)
+
         # プロンプトテンプレートを定義
         prompt = ChatPromptTemplate.from_messages(
             [
@@ -79,7 +184,7 @@ class PersonaGenerator:
                 ),
                 (
                     "human",
-                    f"以下のユーザーリクエストに関するインタビュー用に、{self.k}人の多様なペルソナを生成してください。\n\n"
+                    "以下のユーザーリクエストに関するインタビュー用に、{k}人の多様なペルソナを生成してください。\n\n"
                     "ユーザーリクエスト: {user_request}\n\n"
                     "各ペルソナには名前と簡単な背景を含めてください。年齢、性別、職業、技術的専門知識において多様性を確保してください。",
                 ),
@@ -88,7 +193,38 @@ class PersonaGenerator:
         # ペルソナ生成のためのチェーンを作成
         chain = prompt | self.llm
         # ペルソナを生成
-        return chain.invoke({"user_request": user_request})
+        return chain.invoke({"user_request": user_request, "k": k or self.k})
+
+    def _generate_targeted(
+        self, user_request: str, k: int, gaps: list[InformationGap]
+    ) -> Personas:
+        # 不足情報を補うためのプロンプトを定義
+        prompt = ChatPromptTemplate.from_messages(
+            [
+                (
+                    "system",
+                    "あなたは不足している要件情報を引き出すためのインタビュー用ペルソナを作成する専門家です。",
+                ),
+                (
+                    "human",
+                    "以下のユーザーリクエストについて、これまでのインタビューでは次の情報が不足しています。\n\n"
+                    "ユーザーリクエスト: {user_request}\n\n"
+                    "不足している情報:\n{gaps}\n\n"
+                    "これらの不足情報を最もよく補える{k}人のペルソナを生成してください。"
+                    "各ペルソナには名前と、どの不足情報について語れるかが分かる簡単な背景を含めてください。",
+                ),
+            ]
+        )
+        # ペルソナ生成のためのチェーンを作成
+        chain = prompt | self.llm
+        # ペルソナを生成
+        return chain.invoke(
+            {
+                "user_request": user_request,
+                "k": k,
+                "gaps": "\n".join(f"- {g.category}: {g.description}" for g in gaps),
+            }
+        )
 
 
 # インタビューを実施するクラス
@@ -200,7 +336,9 @@ class InformationEvaluator:
                 ),
                 (
                     "human",
-                    "以下のユーザーリクエストとインタビュー結果に基づいて、包括的な要件文書を作成するのに十分な情報が集まったかどうかを判断してください。\n\n"
+                    "以下のユーザーリクエストとインタビュー結果に基づいて、包括的な要件文書を作成するのに十分な情報が集まったかどうかを判断してください。\n"
+                    "情報が不足している場合は、不足している情報をカテゴリごとに挙げてください。"
+                    "カテゴリは互いに重複しないようにし、本当に追加のインタビューが必要なものだけに絞ってください。\n\n"
                     "ユーザーリクエスト: {user_request}\n\n"
                     "インタビュー結果:\n{interview_results}",
                 ),
@@ -288,13 +426,27 @@ class DocumentGenerationError(AgentError):
     pass
 
 class DocumentationAgent:
-    def __init__(self, llm: ChatOpenAI, k: Optional[int] = None):
+    def __init__(
+        self,
+        llm: ChatOpenAI,
+        k: int = 5,
+        budget: Optional[InterviewBudget] = None,
+        max_iterations: int = 5,
+    ):
         if not isinstance(llm, ChatOpenAI):
             raise ValueError("llm must be an instance of ChatOpenAI")
+        if k < 1:
+            raise ValueError("k must be a positive integer")
+        if max_iterations < 1:
+            raise ValueError("max_iterations must be a positive integer")
 
         try:
             # LLMの保存
             self.llm = llm
+            # 初回に生成するペルソナ数（以降の反復ではこれが上限となる）
+            self.k = k
+            self.budget = budget or InterviewBudget()
+            self.max_iterations = max_iterations
 
             # 各種ジェネレータの初期化
             self.persona_generator = PersonaGenerator(llm=self.llm, k=k)
@@ -327,7 +479,7 @@ class DocumentationAgent:
         # 条件付きエッジの追加
         workflow.add_conditional_edges(
             "evaluate_information",
-            lambda state: not state.is_information_sufficient and state.iteration < 5,
+            lambda state: not state.stop_reason,
             {True: "generate_personas", False: "generate_requirements"},
         )
         workflow.add_edge("generate_requirements", END)
@@ -335,29 +487,129 @@ class DocumentationAgent:
         # グラフのコンパイル
         return workflow.compile()
 
-    def _generate_personas(self, state: InterviewState) -> dict[str, Any]:
-        # ペルソナの生成
-        new_personas: Personas = self.persona_generator.run(state.user_request)
+    @staticmethod
+    def _tokens_used(config: RunnableConfig) -> int:
+        # run_with_stats以外からグラフが実行された場合は集計なしとして扱う
+        token_usage = config.get("configurable", {}).get("token_usage")
+        return token_usage.total_tokens if token_usage else 0
+
+    def _fit_token_budget(
+        self, state: InterviewState, tokens_used: int, count: int
+    ) -> int:
+        # 直前の反復の実績から次の反復の消費量を見積もり、予算に収まる人数まで減らす
+        last_round_interviews = len(state.current_personas)
+        if self.budget.max_tokens is None or not last_round_interviews:
+            return count
+        usage = state.round_tokens
+        tokens_per_interview = usage.interviews / last_round_interviews
+        total_interviews = len(state.interviews)
+        while count > 0:
+            # 評価はそれまでの全インタビューを読むため、件数に比例して増えると見積もる
+            evaluation = usage.evaluation * (total_interviews + count) / total_interviews
+            estimate = (
+                usage.persona_generation + evaluation + count * tokens_per_interview
+            )
+            if tokens_used + estimate <= self.budget.max_tokens:
+                break
+            count -= 1
+        return count
+
+    def _plan_persona_count(self, state: InterviewState, tokens_used: int = 0) -> int:
+        # 初回は指定された人数、以降は不足カテゴリ1つにつき1人（上限k人）
+        # 評価が不足とだけ判断してカテゴリを挙げなかった場合は初回と同じ人数に戻す
+        if state.iteration == 0 or not state.information_gaps:
+            count = self.k
+        else:
+            count = min(len(state.information_gaps), self.k)
+        # インタビュー数の予算を超えないように調整
+        remaining = self.budget.max_interviews - len(state.interviews)
+        count = min(count, remaining)
+        # トークンの予算を超えないように調整
+        return max(self._fit_token_budget(state, tokens_used, count), 0)
+
+    def _stop_reason(
+        self, state: InterviewState, is_sufficient: bool, tokens_used: int
+    ) -> str:
+        # 評価結果を反映したステートから、反復を終了すべき理由を返す（継続する場合は空文字）
+        if is_sufficient:
+            return "sufficient"
+        if state.iteration >= self.max_iterations:
+            return "max_iterations"
+        if len(state.interviews) >= self.budget.max_interviews:
+            return "interview_budget"
+        if self._plan_persona_count(state, tokens_used) < 1:
+            return "token_budget"
+        return ""
+
+    def _generate_personas(
+        self, state: InterviewState, config: RunnableConfig
+    ) -> dict[str, Any]:
+        # 不足情報と残りの予算に応じた人数のペルソナを生成
+        tokens_before = self._tokens_used(config)
+        k = self._plan_persona_count(state, tokens_before)
+        new_personas: Personas = self.persona_generator.run(
+            state.user_request, k=k, gaps=state.information_gaps
+        )
+        # LLMが指定人数より多く返した場合も予算を守る
+        personas = new_personas.personas[:k]
         return {
-            "personas": new_personas.personas,
+            "personas": personas,
+            "current_personas": personas,
             "iteration": state.iteration + 1,
+            "round_tokens": RoundTokenUsage(
+                persona_generation=self._tokens_used(config) - tokens_before
+            ),
         }
 
-    def _conduct_interviews(self, state: InterviewState) -> dict[str, Any]:
-        # インタビューの実施
+    def _conduct_interviews(
+        self, state: InterviewState, config: RunnableConfig
+    ) -> dict[str, Any]:
+        # 現在の反復で生成したペルソナにのみインタビューを実施
+        tokens_before = self._tokens_used(config)
         new_interviews: InterviewResult = self.interview_conductor.run(
-            state.user_request, state.personas[-5:]
+            state.user_request, state.current_personas
         )
-        return {"interviews": new_interviews.interviews}
+        return {
+            "interviews": new_interviews.interviews,
+            "round_tokens": state.round_tokens.model_copy(
+                update={"interviews": self._tokens_used(config) - tokens_before}
+            ),
+        }
 
-    def _evaluate_information(self, state: InterviewState) -> dict[str, Any]:
+    def _evaluate_information(
+        self, state: InterviewState, config: RunnableConfig
+    ) -> dict[str, Any]:
         # 情報の評価
+        tokens_before = self._tokens_used(config)
         evaluation_result: EvaluationResult = self.information_evaluator.run(
             state.user_request, state.interviews
         )
+        gaps = [] if evaluation_result.is_sufficient else evaluation_result.gaps
+        tokens_used = self._tokens_used(config)
+        round_tokens = state.round_tokens.model_copy(
+            update={"evaluation": tokens_used - tokens_before}
+        )
+        evaluated_state = state.model_copy(
+            update={"information_gaps": gaps, "round_tokens": round_tokens}
+        )
         return {
             "is_information_sufficient": evaluation_result.is_sufficient,
             "evaluation_reason": evaluation_result.reason,
+            "information_gaps": gaps,
+            "round_tokens": round_tokens,
+            "iteration_stats": [
+                IterationStats(
+                    iteration=state.iteration,
+                    personas_generated=len(state.current_personas),
+                    gap_count=len(gaps),
+                    is_sufficient=evaluation_result.is_sufficient,
+                    tokens_used=tokens_used,
+                    round_tokens=round_tokens,
+                )
+            ],
+            "stop_reason": self._stop_reason(
+                evaluated_state, evaluation_result.is_sufficient, tokens_used
+            ),
         }
 
     def _generate_requirements(self, state: InterviewState) -> dict[str, Any]:
@@ -367,13 +619,32 @@ class DocumentationAgent:
         )
         return {"requirements_doc": requirements_doc}
 
-    def run(self, user_request: str) -> str:
+    def run_with_stats(self, user_request: str) -> DocumentationResult:
         # 初期状態の設定
         initial_state = InterviewState(user_request=user_request)
+        # リクエスト単位でトークン使用量を集計する
+        token_usage = TokenUsageCallbackHandler()
         # グラフの実行
-        final_state = self.graph.invoke(initial_state)
-        # 最終的な要件定義書の取得
-        return final_state["requirements_doc"]
+        final_state = self.graph.invoke(
+            initial_state,
+            config={
+                "callbacks": [token_usage],
+                "configurable": {"token_usage": token_usage},
+            },
+        )
+        # 最終的な要件定義書と収束統計の取得
+        return DocumentationResult(
+            requirements_doc=final_state["requirements_doc"],
+            stats=ConvergenceStats(
+                iterations=final_state["iteration_stats"],
+                total_interviews=len(final_state["interviews"]),
+                total_tokens=token_usage.total_tokens,
+                stop_reason=final_state["stop_reason"],
+            ),
+        )
+
+    def run(self, user_request: str) -> str:
+        return self.run_with_stats(user_request).requirements_doc
 
 
 # 実行方法:
@@ -400,6 +671,22 @@ def main():
         default=5,
         help="生成するペルソナの人数を設定してください（デフォルト:5）",
     )
+    # インタビュー数とトークン数の予算
+    parser.add_argument(
+        "--max-interviews",
+        type=int,
+        default=15,
+        help="1リクエストで実施するインタビューの最大数（デフォルト:15）",
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=None,
+        help=(
+            "インタビューの反復で消費するトークンの最大数（デフォルト:無制限）。"
+            "要件定義書の生成分は含みません"
+        ),
+    )
     # コマンドライン引数を解析
     args = parser.parse_args()
 
@@ -409,12 +696,20 @@ def main():
         openai_api_key=os.getenv("OPENAI_API_KEY"),
     )
     # 要件定義書生成AIエージェントを初期化
-    agent = DocumentationAgent(llm=llm, k=args.k)
+    agent = DocumentationAgent(
+        llm=llm,
+        k=args.k,
+        budget=InterviewBudget(
+            max_interviews=args.max_interviews, max_tokens=args.max_tokens
+        ),
+    )
     # エージェントを実行して最終的な出力を取得
-    final_output = agent.run(user_request=args.task)
+    result = agent.run_with_stats(user_request=args.task)
 
     # 最終的な出力を表示
-    print(final_output)
+    print(result.requirements_doc)
+    # 収束統計を表示
+    print(result.stats.model_dump_json(indent=2))
 
 
 if __name__ == "__main__":
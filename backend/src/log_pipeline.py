@@ -0,0 +1,243 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Optional
+
+# LogRecordが標準で持つ属性（これ以外はextraで渡された構造化フィールドとして扱う）
+_RESERVED_ATTRS = frozenset(
+    logging.LogRecord("", 0, "", 0, "", (), None).__dict__.keys()
+) | {"message", "asctime"}
+
+# JsonFormatterが出力する固定のキー（extraで同名のフィールドが渡されても上書きさせない）
+_PAYLOAD_KEYS = frozenset(
+    {"time", "severity", "logger", "message", "exception", "stack_info"}
+)
+
+
+def truncate(value: str, max_length: int) -> str:
+    """長い文字列を切り詰め、元の長さが分かるように印を付ける"""
+    if len(value) <= max_length:
+        return value
+    return f"{value[:max_length]}...[truncated {len(value) - max_length} chars]"
+
+
+def _match_logger(name: str, table: dict[str, Any]) -> Optional[Any]:
+    """ロガー名に最も長く一致する設定値を返す（"main"の設定は"main.request"にも効く）"""
+    while name:
+        if name in table:
+            return table[name]
+        name = name.rpartition(".")[0]
+    return table.get("")
+
+
+class JsonFormatter(logging.Formatter):
+    """Cloud Runが構造化ログとして取り込める1行JSON形式に整形する
+
+    WARNING未満のレコードは、メッセージとextraのフィールドをmax_field_length文字に
+    切り詰める。文字列以外のフィールド（リストや辞書など）はJSON化した長さで判定する。
+    WARNING以上のレコードと例外のトレースバックは切り詰めない。
+    extraのフィールドがseverityなどの固定のキーと重なる場合は"extra_"を付けて出力する。
+    """
+
+    def __init__(self, max_field_length: Optional[int] = None):
+        super().__init__()
+        self.max_field_length = max_field_length
+
+    def format(self, record: logging.LogRecord) -> str:
+        limit = self.max_field_length if record.levelno < logging.WARNING else None
+        payload: dict[str, Any] = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "severity": record.levelname,
+            "logger": record.name,
+            "message": self._limit(record.getMessage(), limit),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and not key.startswith("_"):
+                if key in _PAYLOAD_KEYS:
+                    key = f"extra_{key}"
+                payload[key] = self._limit(value, limit)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload["exception"] = record.exc_text
+        if record.stack_info:
+            payload["stack_info"] = record.stack_info
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+    @staticmethod
+    def _limit(value: Any, limit: Optional[int]) -> Any:
+        if limit is None or value is None or isinstance(value, (bool, int, float)):
+            return value
+        if isinstance(value, str):
+            return truncate(value, limit)
+        # リストや辞書などは、JSON化して上限を超える場合のみ切り詰めた文字列に置き換える
+        text = json.dumps(value, ensure_ascii=False, default=str)
+        return truncate(text, limit) if len(text) > limit else value
+
+
+class SamplingFilter(logging.Filter):
+    """ロガーごとのサンプリングとレート制限を行うフィルタ
+
+    WARNING以上のレコードは常に通す。判定はキューに積む前に行うため、
+    捨てられたレコードは整形も出力もされない。
+    """
+
+    def __init__(
+        self,
+        sample_rates: Optional[dict[str, float]] = None,
+        rate_limits: Optional[dict[str, float]] = None,
+    ):
+        super().__init__()
+        self.sample_rates = sample_rates or {}
+        self.rate_limits = rate_limits or {}
+        self.dropped = 0
+        self._lock = threading.Lock()
+        # ロガー名 -> (残りトークン数, 最終補充時刻)
+        self._buckets: dict[str, tuple[float, float]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        rate = _match_logger(record.name, self.sample_rates)
+        if rate is not None and random.random() >= rate:
+            return self._drop()
+
+        limit = _match_logger(record.name, self.rate_limits)
+        if limit is not None and not self._take_token(record.name, limit):
+            return self._drop()
+        return True
+
+    def _take_token(self, name: str, limit: float) -> bool:
+        # 1秒あたりlimit件を上限とするトークンバケット
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(name, (limit, now))
+            tokens = min(limit, tokens + (now - last) * limit)
+            if tokens < 1:
+                self._buckets[name] = (tokens, now)
+                return False
+            self._buckets[name] = (tokens - 1, now)
+            return True
+
+    def _drop(self) -> bool:
+        with self._lock:
+            self.dropped += 1
+        return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """呼び出し元のスレッドでは最小限の処理だけを行ってキューに積むハンドラ
+
+    キューが満杯の場合はリクエスト処理をブロックせずにレコードを捨てる。
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._exception_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # QueueHandler.prepareと異なり、整形（formatの呼び出し）は行わない。
+        # 後続のハンドラが元のレコードを使えるよう、変更は浅いコピーに対して行う
+        # （copy.copyより速いため、__dict__を直接複製する）
+        original = record
+        record = original.__class__.__new__(original.__class__)
+        record.__dict__.update(original.__dict__)
+        # 引数は後から変更される可能性があるため、メッセージの文字列化だけはここで行う
+        record.msg = record.getMessage()
+        record.args = None
+        # トレースバックはフレームを参照し続けないよう、ここで文字列化する
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self._exception_formatter.formatException(
+                    record.exc_info
+                )
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class StoppableQueueListener(logging.handlers.QueueListener):
+    """stopを複数回呼んでも安全なQueueListener
+
+    Python 3.11以前では、停止済みのリスナーに対してstopを呼ぶとAttributeErrorになる。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stop_lock = threading.Lock()
+        self._running = False
+
+    def start(self) -> None:
+        with self._stop_lock:
+            if not self._running:
+                super().start()
+                self._running = True
+
+    def stop(self) -> None:
+        with self._stop_lock:
+            if self._running:
+                super().stop()
+                self._running = False
+
+
+def _detach_handlers(logger: logging.Logger) -> None:
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def setup_logging(
+    level: int = logging.INFO,
+    sample_rates: Optional[dict[str, float]] = None,
+    rate_limits: Optional[dict[str, float]] = None,
+    max_field_length: int = 2000,
+    queue_size: int = 10000,
+    stream=None,
+    capture_loggers: tuple[str, ...] = ("uvicorn", "uvicorn.access", "uvicorn.error"),
+) -> StoppableQueueListener:
+    """ルートロガーを非同期のJSONログパイプラインに差し替える
+
+    ログ呼び出し側ではフィルタ判定とメッセージの文字列化だけを行い、切り詰め、
+    JSON整形、出力はQueueListenerのスレッドで行う。capture_loggersに指定した
+    ロガー（uvicornのアクセスログなど）は独自のハンドラを外してルートに流す。
+    返したリスナーはプロセス終了時に停止する。
+    """
+    log_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rates, rate_limits))
+
+    stream_handler = logging.StreamHandler(stream or sys.stdout)
+    stream_handler.setFormatter(JsonFormatter(max_field_length=max_field_length))
+
+    root = logging.getLogger()
+    _detach_handlers(root)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    for name in capture_loggers:
+        captured = logging.getLogger(name)
+        _detach_handlers(captured)
+        captured.propagate = True
+
+    listener = StoppableQueueListener(
+        log_queue, stream_handler, respect_handler_level=True
+    )
+    listener.start()
+    # 終了時にキューに残ったログを書き出す
+    atexit.register(listener.stop)
+    return listener
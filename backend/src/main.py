@@ -12,16 +12,31 @@ from langchain_openai import ChatOpenAI
 import json
 import sys
 import asyncio
+from log_pipeline import setup_logging
 from google.auth import default
 from google.auth.transport.requests import Request as GoogleRequest
 
 # ロギングの設定
-logging.basicConfig(
+# ログの整形と出力は別スレッドで行い、リクエスト処理のイベントループをブロックしない
+# uvicornのアクセスログも同じキューを通し、サンプリングとレート制限の対象とする
+# Cloud Runでは標準出力のJSONがそのまま構造化ログとしてCloud Loggingに取り込まれる
+request_sample_rate = float(os.getenv("LOG_REQUEST_SAMPLE_RATE", "1.0"))
+request_rate_limit = float(os.getenv("LOG_REQUEST_RATE_LIMIT", "50"))
+log_listener = setup_logging(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    stream=sys.stdout  # 標準出力にログを出力
+    sample_rates={
+        f"{__name__}.request": request_sample_rate,
+        "uvicorn.access": request_sample_rate,
+    },
+    rate_limits={
+        f"{__name__}.request": request_rate_limit,
+        "uvicorn.access": request_rate_limit,
+    },
+    max_field_length=int(os.getenv("LOG_MAX_FIELD_LENGTH", "2000")),
 )
 logger = logging.getLogger(__name__)
+# リクエスト処理中のログ（サンプリングとレート制限の対象）
+request_logger = logger.getChild("request")
 
 # 起動時の環境情報をログに記録
 logger.info("Application starting...")
@@ -35,19 +50,9 @@ logger.info(f"Files in current directory: {os.listdir('.')}")
 is_cloud_run = os.getenv('K_SERVICE') is not None
 logger.info(f"Running in Cloud Run: {is_cloud_run}")
 
-# Cloud Run環境でのみ Cloud Loggingを設定
-if is_cloud_run:
-    try:
-        from google.cloud import logging as cloud_logging
-        client = cloud_logging.Client()
-        handler = cloud_logging.handlers.CloudLoggingHandler(client)
-        cloud_logger = logging.getLogger('cloudLogger')
-        cloud_logger.setLevel(logging.INFO)
-        cloud_logger.addHandler(handler)
-        logger.info("Cloud Logging initialized successfully")
-    except Exception as e:
-        logger.warning(f"Failed to initialize Cloud Logging: {e}")
-        cloud_logger = logger  # フォールバックとして通常のロガーを使用
+# ローカル環境ではトークン検証をスキップする旨を起動時に一度だけ通知
+if not is_cloud_run:
+    logger.warning('Running in local environment - skipping token verification')
 
 # .envファイルを読み込む
 load_dotenv()
@@ -116,7 +121,6 @@ async def log_request(request: Request, call_next):
 
     # ローカル環境では認証をスキップ
     if not is_cloud_run:
-        logger.warning('Running in local environment - skipping token verification')
         return await call_next(request)
 
     auth_header = request.headers.get('Authorization')
@@ -154,7 +158,7 @@ async def log_request(request: Request, call_next):
             ]:
                 raise ValueError('Invalid token issuer')
             
-            logger.info(f"Token verified successfully for audience: {audience}")
+            request_logger.info(f"Token verified successfully for audience: {audience}")
         except Exception as e:
             logger.error(f"Token verification failed: {str(e)}")
             return JSONResponse(
@@ -211,23 +215,38 @@ except Exception as e:
 @app.post("/api/chat")
 async def chat_endpoint(request: ChatRequest):
     request_id = str(uuid.uuid4())
-    logger.info(f"Request ID: {request_id} - Starting request processing")
-    logger.info(f"Processing message: {request.message}")
-    
+    # メッセージ本文は出力せず、長さだけを記録する
+    request_logger.info(
+        "Starting request processing",
+        extra={"request_id": request_id, "message_length": len(request.message)},
+    )
+    request_logger.debug(
+        "Processing message",
+        extra={"request_id": request_id, "user_message": request.message},
+    )
+
     try:
         # ストリーミングレスポンスを作成
         async def generate_response():
             try:
-                # エージェントの状態をログに記録
-                logger.info("Agent state before processing:")
-                logger.info(f"LLM model: {agent.llm.model_name}")
-                
                 try:
                     # 非同期でレスポンスを生成
-                    response = await asyncio.to_thread(
-                        agent.run,
+                    result = await asyncio.to_thread(
+                        agent.run_with_stats,
                         request.message
                     )
+                    stats = result.stats
+                    request_logger.info(
+                        "Request completed",
+                        extra={
+                            "request_id": request_id,
+                            "iterations": len(stats.iterations),
+                            "stop_reason": stats.stop_reason,
+                            "interviews": stats.total_interviews,
+                            "tokens": stats.total_tokens,
+                        },
+                    )
+                    response = result.requirements_doc
                     
                     # レスポンスを文字列に変換してyieldする
                     if isinstance(response, (dict, list)):
@@ -236,7 +255,10 @@ async def chat_endpoint(request: ChatRequest):
                         yield str(response)
                         
                 except Exception as e:
-                    logger.error(f"Error in agent.run: {str(e)}")
+                    logger.error(
+                        f"Error in agent.run: {str(e)}",
+                        extra={"request_id": request_id},
+                    )
                     yield json.dumps({
                         "error": "Failed to process request",
                         "details": str(e)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# backend/src をインポートパスに追加（Dockerイメージでは PYTHONPATH=/app に相当）
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
@@ -0,0 +1,241 @@
+import pytest
+
+pytest.importorskip("langgraph")
+
+from langchain_core.messages import AIMessage  # noqa: E402
+from langchain_core.outputs import ChatGeneration, ChatResult  # noqa: E402
+from langchain_openai import ChatOpenAI  # noqa: E402
+
+from docubot_agent.main import (  # noqa: E402
+    DocumentationAgent,
+    EvaluationResult,
+    InformationGap,
+    Interview,
+    InterviewBudget,
+    InterviewResult,
+    InterviewState,
+    Persona,
+    Personas,
+    RoundTokenUsage,
+)
+
+
+def make_agent(**kwargs) -> DocumentationAgent:
+    # LLMは呼び出さないため、APIキーはダミーでよい
+    llm = ChatOpenAI(model="gpt-4o", api_key="sk-test")
+    return DocumentationAgent(llm=llm, **kwargs)
+
+
+def make_state(
+    iteration: int = 0,
+    interviews: int = 0,
+    gaps: int = 0,
+    last_round: int = 0,
+    round_tokens: RoundTokenUsage = RoundTokenUsage(),
+) -> InterviewState:
+    persona = Persona(name="佐藤", background="会社員")
+    return InterviewState(
+        user_request="健康管理アプリ",
+        iteration=iteration,
+        interviews=[
+            Interview(persona=persona, question="質問", answer="回答")
+            for _ in range(interviews)
+        ],
+        current_personas=[persona] * last_round,
+        information_gaps=[
+            InformationGap(category=f"カテゴリ{i}", description="不足")
+            for i in range(gaps)
+        ],
+        round_tokens=round_tokens,
+    )
+
+
+# 前の反復: 5人にインタビューし、ペルソナ生成100、インタビュー500（1件100）、評価200トークン
+LAST_ROUND_TOKENS = RoundTokenUsage(persona_generation=100, interviews=500, evaluation=200)
+
+
+def test_first_round_uses_k():
+    agent = make_agent(k=5)
+    assert agent._plan_persona_count(make_state(iteration=0)) == 5
+
+
+@pytest.mark.parametrize("gaps, expected", [(2, 2), (8, 5), (0, 5)])
+def test_later_rounds_use_gap_count_capped_at_k(gaps, expected):
+    agent = make_agent(k=5)
+    state = make_state(iteration=1, interviews=5, gaps=gaps)
+    assert agent._plan_persona_count(state) == expected
+
+
+def test_persona_count_clamped_to_remaining_interviews():
+    agent = make_agent(k=5, budget=InterviewBudget(max_interviews=7))
+    state = make_state(iteration=1, interviews=5, gaps=4)
+    assert agent._plan_persona_count(state) == 2
+
+
+def test_persona_count_clamped_to_remaining_tokens():
+    agent = make_agent(k=5, budget=InterviewBudget(max_tokens=1600))
+    # 次の反復の見積もり: 100 + 200 * (5 + c) / 5 + 100 * c = 300 + 140 * c
+    # 残り600トークンに収まるのは c = 2
+    state = make_state(
+        iteration=1, interviews=5, gaps=4, last_round=5, round_tokens=LAST_ROUND_TOKENS
+    )
+    assert agent._plan_persona_count(state, tokens_used=1000) == 2
+
+
+@pytest.mark.parametrize(
+    "is_sufficient, iteration, interviews, tokens_used, budget, expected",
+    [
+        (True, 1, 5, 0, InterviewBudget(), "sufficient"),
+        (False, 5, 5, 0, InterviewBudget(), "max_iterations"),
+        (False, 2, 15, 0, InterviewBudget(max_interviews=15), "interview_budget"),
+        # 残り400トークンでは1人分（440トークン）も収まらない
+        (False, 1, 5, 1000, InterviewBudget(max_tokens=1400), "token_budget"),
+        (False, 1, 5, 1000, InterviewBudget(max_tokens=1440), ""),
+        (False, 1, 5, 0, InterviewBudget(), ""),
+    ],
+)
+def test_stop_reason(is_sufficient, iteration, interviews, tokens_used, budget, expected):
+    agent = make_agent(k=5, budget=budget)
+    state = make_state(
+        iteration=iteration,
+        interviews=interviews,
+        gaps=2,
+        last_round=5,
+        round_tokens=LAST_ROUND_TOKENS,
+    )
+    assert agent._stop_reason(state, is_sufficient, tokens_used) == expected
+
+
+@pytest.mark.parametrize("kwargs", [{"k": 0}, {"max_iterations": 0}])
+def test_rejects_non_positive_limits(kwargs):
+    with pytest.raises(ValueError):
+        make_agent(**kwargs)
+
+
+class StubPersonaGenerator:
+    def __init__(self):
+        self.requested: list[int] = []
+
+    def run(self, user_request, k=None, gaps=None):
+        self.requested.append(k)
+        return Personas(
+            personas=[Persona(name=f"ペルソナ{i}", background="背景") for i in range(k)]
+        )
+
+
+class StubInterviewConductor:
+    def run(self, user_request, personas):
+        return InterviewResult(
+            interviews=[
+                Interview(persona=p, question="質問", answer="回答") for p in personas
+            ]
+        )
+
+
+class StubInformationEvaluator:
+    def __init__(self, results: list[EvaluationResult]):
+        self.results = results
+
+    def run(self, user_request, interviews):
+        return self.results.pop(0)
+
+
+class StubRequirementsGenerator:
+    def run(self, user_request, interviews):
+        return f"要件定義書（インタビュー{len(interviews)}件）"
+
+
+def test_run_with_stats_shrinks_later_rounds_to_gaps():
+    agent = make_agent(k=5)
+    agent.persona_generator = StubPersonaGenerator()
+    agent.interview_conductor = StubInterviewConductor()
+    agent.information_evaluator = StubInformationEvaluator(
+        [
+            EvaluationResult(
+                reason="非機能要件が不足",
+                is_sufficient=False,
+                gaps=[
+                    InformationGap(category="性能", description="応答時間"),
+                    InformationGap(category="セキュリティ", description="認証方式"),
+                ],
+            ),
+            EvaluationResult(reason="十分", is_sufficient=True, gaps=[]),
+        ]
+    )
+    agent.requirements_generator = StubRequirementsGenerator()
+
+    result = agent.run_with_stats("健康管理アプリ")
+
+    assert agent.persona_generator.requested == [5, 2]
+    assert result.requirements_doc == "要件定義書（インタビュー7件）"
+    assert result.stats.stop_reason == "sufficient"
+    assert result.stats.total_interviews == 7
+    assert [s.personas_generated for s in result.stats.iterations] == [5, 2]
+    assert [s.gap_count for s in result.stats.iterations] == [2, 0]
+
+
+def test_graph_runs_without_token_usage_config():
+    agent = make_agent(k=2, max_iterations=1)
+    agent.persona_generator = StubPersonaGenerator()
+    agent.interview_conductor = StubInterviewConductor()
+    agent.information_evaluator = StubInformationEvaluator(
+        [EvaluationResult(reason="不足", is_sufficient=False, gaps=[])]
+    )
+    agent.requirements_generator = StubRequirementsGenerator()
+
+    final_state = agent.graph.invoke(InterviewState(user_request="健康管理アプリ"))
+
+    assert final_state["stop_reason"] == "max_iterations"
+    assert final_state["iteration_stats"][0].tokens_used == 0
+
+
+class TokenCountingChatOpenAI(ChatOpenAI):
+    # 入力の文字数に比例したトークン使用量を返す（評価は反復ごとに入力が増える）
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = 10 + sum(len(m.content) for m in messages) // 10
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content="回答" * 5))],
+            llm_output={"token_usage": {"total_tokens": tokens}},
+        )
+
+
+class LLMPersonaGenerator(StubPersonaGenerator):
+    def __init__(self, llm):
+        super().__init__()
+        self.llm = llm
+
+    def run(self, user_request, k=None, gaps=None):
+        self.llm.invoke(f"{k}人のペルソナを生成してください: {user_request}")
+        return super().run(user_request, k=k, gaps=gaps)
+
+
+class LLMInformationEvaluator:
+    def __init__(self, llm):
+        self.llm = llm
+
+    def run(self, user_request, interviews):
+        self.llm.invoke(
+            "\n".join(f"{i.persona.background} {i.question} {i.answer}" for i in interviews)
+        )
+        return EvaluationResult(
+            reason="不足",
+            is_sufficient=False,
+            gaps=[InformationGap(category=str(i), description="不足") for i in range(3)],
+        )
+
+
+@pytest.mark.parametrize("max_tokens", [250, 400, 600, 1000])
+def test_run_with_stats_stays_within_token_budget(max_tokens):
+    llm = TokenCountingChatOpenAI(model="gpt-4o", api_key="sk-test")
+    agent = DocumentationAgent(
+        llm=llm, k=3, budget=InterviewBudget(max_tokens=max_tokens)
+    )
+    agent.persona_generator = LLMPersonaGenerator(llm)
+    agent.information_evaluator = LLMInformationEvaluator(llm)
+    # 要件定義書の生成は予算の対象外のため、LLMを呼ばないスタブにする
+    agent.requirements_generator = StubRequirementsGenerator()
+
+    result = agent.run_with_stats("健康管理アプリ")
+
+    assert result.stats.total_tokens <= max_tokens
+    assert result.stats.stop_reason in ("token_budget", "max_iterations")
@@ -0,0 +1,138 @@
+import io
+import json
+import logging
+
+import pytest
+
+from log_pipeline import JsonFormatter, SamplingFilter, setup_logging
+
+
+def reset_root() -> None:
+    for handler in logging.getLogger().handlers[:]:
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+
+
+@pytest.fixture
+def pipeline():
+    stream = io.StringIO()
+    listener = setup_logging(stream=stream, max_field_length=20)
+    yield stream, listener
+    listener.stop()
+    reset_root()
+
+
+def read_records(stream: io.StringIO, listener) -> list[dict]:
+    listener.stop()
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_info_message_and_payloads_are_truncated(pipeline):
+    stream, listener = pipeline
+    logging.getLogger("main.request").info(
+        "x" * 50, extra={"payload": list(range(50)), "small": [1, 2], "count": 3}
+    )
+    (record,) = read_records(stream, listener)
+    assert record["message"].startswith("x" * 20 + "...[truncated 30 chars]")
+    assert record["payload"].startswith("[0, 1, 2")
+    assert "truncated" in record["payload"]
+    assert record["small"] == [1, 2]
+    assert record["count"] == 3
+
+
+def test_exception_is_kept_in_full(pipeline):
+    stream, listener = pipeline
+    try:
+        raise ValueError("e" * 100)
+    except ValueError:
+        logging.getLogger("main.request").exception("failed " + "m" * 50)
+    (record,) = read_records(stream, listener)
+    assert record["severity"] == "ERROR"
+    assert record["message"] == "failed " + "m" * 50
+    assert record["exception"].startswith("Traceback (most recent call last):")
+    assert record["exception"].endswith("ValueError: " + "e" * 100)
+
+
+def test_extra_fields_cannot_override_fixed_keys(pipeline):
+    stream, listener = pipeline
+    logging.getLogger("main.request").info(
+        "msg", extra={"severity": "CRITICAL", "time": "then", "logger": "other"}
+    )
+    (record,) = read_records(stream, listener)
+    assert record["severity"] == "INFO"
+    assert record["logger"] == "main.request"
+    assert record["extra_severity"] == "CRITICAL"
+    assert record["extra_time"] == "then"
+    assert record["extra_logger"] == "other"
+
+
+def test_later_handlers_see_the_original_record(pipeline):
+    stream, listener = pipeline
+    seen: list[logging.LogRecord] = []
+
+    class Recorder(logging.Handler):
+        def emit(self, record):
+            seen.append(record)
+
+    root = logging.getLogger()
+    recorder = Recorder()
+    root.addHandler(recorder)
+    try:
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logging.getLogger("main.request").exception("failed %s", "here")
+    finally:
+        root.removeHandler(recorder)
+    (record,) = seen
+    assert record.exc_info is not None
+    assert record.args == ("here",)
+    assert read_records(stream, listener)[0]["message"] == "failed here"
+
+
+def test_stop_is_idempotent(pipeline):
+    _, listener = pipeline
+    listener.stop()
+    listener.stop()
+
+
+def test_uvicorn_loggers_are_routed_through_the_queue():
+    access = logging.getLogger("uvicorn.access")
+    access.addHandler(logging.NullHandler())
+    access.propagate = False
+    stream = io.StringIO()
+    listener = setup_logging(stream=stream)
+    try:
+        assert access.handlers == []
+        access.info('%s - "%s %s HTTP/%s" %d', "127.0.0.1:1", "GET", "/", "1.1", 200)
+        (record,) = read_records(stream, listener)
+        assert record["logger"] == "uvicorn.access"
+        assert record["message"] == '127.0.0.1:1 - "GET / HTTP/1.1" 200'
+    finally:
+        listener.stop()
+        reset_root()
+
+
+def make_record(name: str, level: int = logging.INFO) -> logging.LogRecord:
+    return logging.LogRecord(name, level, "", 0, "msg", None, None)
+
+
+def test_sampling_filter_drops_below_warning_only():
+    sampling = SamplingFilter(sample_rates={"main.request": 0.0})
+    assert not sampling.filter(make_record("main.request"))
+    assert sampling.filter(make_record("main.request", logging.WARNING))
+    assert sampling.filter(make_record("main"))
+    assert sampling.dropped == 1
+
+
+def test_rate_limit_applies_per_logger_prefix():
+    sampling = SamplingFilter(rate_limits={"main": 2})
+    results = [sampling.filter(make_record("main.request")) for _ in range(5)]
+    assert results == [True, True, False, False, False]
+
+
+def test_formatter_does_not_truncate_warnings():
+    formatter = JsonFormatter(max_field_length=5)
+    record = make_record("main", logging.WARNING)
+    record.msg = "w" * 10
+    assert json.loads(formatter.format(record))["message"] == "w" * 10